@@ -19,6 +19,7 @@
 #
 ##############################################################################################################
 
+import functools
 import json
 import logging
 import os
@@ -59,6 +60,7 @@ class Service:
     restart_after_upgrade: bool = True
 
 
+@functools.lru_cache(maxsize=None)
 def get_template(name, default=""):
     file = Path(name)
     if file.exists():
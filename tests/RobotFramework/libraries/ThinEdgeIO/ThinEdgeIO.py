@@ -212,10 +212,10 @@ class ThinEdgeIO(DeviceLibrary):
             log.warning("Failed to retrieve logs. %s", ex, exc_info=True)
 
         log_output = super().get_logs(device.get_id(), date_from=date_from, show=False)
-        if show:
+        if show and log_output:
+            # Write all lines in one go rather than issuing a write per line
             hide_sensitive = self._hide_sensitive_factory()
-            for line in log_output:
-                print(hide_sensitive(line))
+            print("\n".join(hide_sensitive(line) for line in log_output))
 
     def _hide_sensitive_factory(self):
         # This is fragile and should be improved upon once a more suitable/robust method of logging and querying
@@ -268,7 +268,7 @@ class ThinEdgeIO(DeviceLibrary):
             device = self.current
 
         if not device:
-            log.info(f"No certificate to remove as the device as not been set")
+            log.info("No certificate to remove as the device as not been set")
             return
 
         result = device.execute_command(
@@ -293,7 +293,7 @@ class ThinEdgeIO(DeviceLibrary):
             device = self.current
 
         if not device:
-            log.info(f"No device to remove as device context is not set")
+            log.info("No device to remove as device context is not set")
             return
 
         try:
@@ -508,8 +508,10 @@ class ThinEdgeIO(DeviceLibrary):
     def _assert_health_status(self, service: str, status: str, device: str = "main") -> Dict[str, Any]:
         # if mqtt.client.auth.ca_file or mqtt.client.auth.ca_dir is set, we pass setting
         # value to mosquitto_sub
-        mqtt_config_options = self.execute_command(
-            f"tedge config list", stdout=True, stderr=False, ignore_exit_code=True
+        mqtt_config_options = parse_config_list(
+            self.execute_command(
+                "tedge config list", stdout=True, stderr=False, ignore_exit_code=True
+            )
         )
 
         server_auth = ""
@@ -520,8 +522,16 @@ class ThinEdgeIO(DeviceLibrary):
         if "mqtt.client.auth.cert_file" in mqtt_config_options:
             client_auth = "--cert /setup/client.crt --key /setup/client.key"
 
+        # Reuse the already listed settings rather than calling tedge config get for each value
+        mqtt_host = mqtt_config_options.get(
+            "mqtt.client.host", "$(tedge config get mqtt.client.host)"
+        )
+        mqtt_port = mqtt_config_options.get(
+            "mqtt.client.port", "$(tedge config get mqtt.client.port)"
+        )
+
         message = self.execute_command(
-            f"mosquitto_sub -t 'te/device/{device}/service/{service}/status/health' --retained-only -C 1 -W 5 -h $(tedge config get mqtt.client.host) -p $(tedge config get mqtt.client.port) {server_auth} {client_auth}",
+            f"mosquitto_sub -t 'te/device/{device}/service/{service}/status/health' --retained-only -C 1 -W 5 -h {mqtt_host} -p {mqtt_port} {server_auth} {client_auth}",
             stdout=True,
             stderr=False,
         )
@@ -748,3 +758,15 @@ def mqtt_topic_match(matcher, topic) -> bool:
         return True
     except StopIteration:
         return False
+
+
+def parse_config_list(output: str) -> Dict[str, str]:
+    """Parse the output of `tedge config list` into a dictionary
+    so that multiple keys can be checked without rescanning the output
+    """
+    config = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            config[key.strip()] = value.strip()
+    return config
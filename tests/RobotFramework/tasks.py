@@ -102,7 +102,7 @@ def remove_duplicate_container_networks(cli: str, name: str):
 
     if len(network_ids) > 1:
         log.warning(
-            f"More than 1 network detected. Keep the first network and removing the rest"
+            "More than 1 network detected. Keep the first network and removing the rest"
         )
         for network_id in network_ids[1:]:
             try:
@@ -8,7 +8,9 @@ import random
 import re
 import sys
 import shutil
+import socket
 import subprocess
+import threading
 import time
 from enum import Enum
 from itertools import cycle
@@ -51,6 +53,22 @@ class TelemetryType(Enum):
         return default_value
 
 
+# Topic suffix used when publishing each telemetry type to thin-edge.io
+TELEMETRY_TOPICS = {
+    TelemetryType.MEASUREMENT: "m",
+    TelemetryType.EVENT: "e",
+    TelemetryType.ALARM: "a",
+}
+
+# Topic which the mapper publishes each telemetry type to for the cloud
+CLOUD_TOPICS = {
+    TelemetryType.MEASUREMENT: "c8y/measurement/measurements/create",
+    TelemetryType.ALARM: "c8y/alarm/alarms/create",
+    TelemetryType.EVENT: "c8y/event/events/create",
+}
+CLOUD_TOPIC_NAMES = frozenset(CLOUD_TOPICS.values())
+
+
 class Pub:
     def __init__(
         self,
@@ -82,7 +100,9 @@ class Pub:
         self.datapoints = datapoints
         self.telemetry_type = telemetry_type
 
-        self.__ready = False
+        # Events are created in run() as the instance is pickled when sent to the worker pool
+        self.__ready: threading.Event = None
+        self.__finished: threading.Event = None
         self.__c8y_messages = []
         self.start_time = None
 
@@ -92,13 +112,8 @@ class Pub:
 
     def get_topic(self, telemetry_type: TelemetryType, type_name: str) -> str:
         sep = "/"
-        telemetry_topics = {
-            TelemetryType.MEASUREMENT: "m",
-            TelemetryType.EVENT: "e",
-            TelemetryType.ALARM: "a",
-        }
         return sep.join(
-            [self.topic_prefix, telemetry_topics[self.telemetry_type], type_name]
+            [self.topic_prefix, TELEMETRY_TOPICS[telemetry_type], type_name]
         )
 
     def __on_connect(self, client: mqtt.Client, userdata, flags, rc):
@@ -107,46 +122,36 @@ class Pub:
 
         # observe which messages are being sent
         LOG.info("Subscribing to cloud topic")
-        topics = {
-            TelemetryType.MEASUREMENT: "c8y/measurement/measurements/create",
-            TelemetryType.ALARM: "c8y/alarm/alarms/create",
-            TelemetryType.EVENT: "c8y/event/events/create",
-        }
-        topic = topics[self.telemetry_type]
+        topic = CLOUD_TOPICS[self.telemetry_type]
         client.subscribe(
             [
                 (topic, 0),
             ]
         )
-        self.__ready = True
+        self.__ready.set()
 
     def __on_message(self, _client, _userdata, msg: mqtt.MQTTMessage):
         try:
             LOG.debug("Received message: %s", msg.payload)
             payload = json.loads(msg.payload.decode("utf-8"))
-            if msg.topic == "c8y/measurement/measurements/create":
-                if "msgid" in payload:
-                    self.__c8y_messages.append(payload)
-            elif msg.topic == "c8y/event/events/create":
-                if "msgid" in payload:
-                    self.__c8y_messages.append(payload)
-            elif msg.topic == "c8y/alarm/alarms/create":
-                if "msgid" in payload:
-                    self.__c8y_messages.append(payload)
+            if msg.topic in CLOUD_TOPIC_NAMES and "msgid" in payload:
+                self.__c8y_messages.append(payload)
         except Exception as ex:
             LOG.debug("Could not parse payload. %s", ex)
 
+        if len(self.__c8y_messages) >= self.count:
+            self.__finished.set()
+
     def wait_until_finished(self, wait: float = 5.0):
-        expire = time.monotonic() + wait
-        timeout = False
-        while len(self.__c8y_messages) < self.count:
-            time.sleep(0.1)
+        """Wait until all of the published messages have been received from the cloud topics
 
-            if time.monotonic() > expire:
-                timeout = True
-                break
+        Args:
+            wait (float): Time to wait in seconds for the messages
 
-        return timeout
+        Returns:
+            bool: True if the wait timed out
+        """
+        return not self.__finished.wait(wait)
 
     def wait_until_ready(self, wait: float = 5.0):
         """Wait until the test is ready
@@ -154,19 +159,13 @@ class Pub:
         Args:
             wait (float): Time to wait in seconds for the benchmark client to be ready
         """
-        expire = time.monotonic() + wait
-        timeout = False
-        while not self.__ready:
-            time.sleep(0.1)
-
-            if time.monotonic() > expire:
-                timeout = True
-                break
-
-        if timeout:
+        if not self.__ready.wait(wait):
             raise RuntimeError(f"Benchmark client is not ready after {wait} seconds")
 
     def run(self, procID, *args, **kwargs):
+        self.__ready = threading.Event()
+        self.__finished = threading.Event()
+
         client = mqtt.Client()
         client.on_connect = self.__on_connect
         client.on_message = self.__on_message
@@ -178,50 +177,53 @@ class Pub:
 
         self.start_time = datetime.datetime.utcnow()
 
-        # Build fixed payload
-        if self.telemetry_type == TelemetryType.MEASUREMENT:
-            payload_fixed = {
-                f"data_{i}": round(random.uniform(20, 30), 2)
-                for i in range(self.datapoints)
-            }
-        elif self.telemetry_type == TelemetryType.EVENT:
-            payload_fixed = {
-                f"data_{i}": round(random.uniform(20, 30), 2)
-                for i in range(self.datapoints)
-            }
+        # Build fixed payload (the datapoints are the same for all telemetry types)
+        payload_fixed = {
+            f"data_{i}": round(random.uniform(20, 30), 2)
+            for i in range(self.datapoints)
+        }
+        if self.telemetry_type == TelemetryType.EVENT:
             payload_fixed["text"] = "Test event"
         elif self.telemetry_type == TelemetryType.ALARM:
-            payload_fixed = {
-                f"data_{i}": round(random.uniform(20, 30), 2)
-                for i in range(self.datapoints)
-            }
             payload_fixed["text"] = "Test alarm"
 
+        # Encode the fixed part of the payload once, so only the per message
+        # fields need to be formatted when publishing. The output is identical
+        # to json.dumps({"msgid": ..., "_generatedAt": ..., **payload_fixed})
+        payload_fixed_json = json.dumps(payload_fixed)[1:-1]
+        payload_suffix = f", {payload_fixed_json}}}" if payload_fixed_json else "}"
+
         payload_bytes = 0
 
         burst_beats = self.beats
         beat_delay = self.beats_delay
         period = self.period
 
+        # Local references for the publish loop
+        qos = self.qos
+        publish = client.publish
+        utcnow = datetime.datetime.utcnow
+        debug_enabled = LOG.isEnabledFor(logging.DEBUG)
+
         idle_time_ms = 0
         beat_start = time.monotonic()
         beat_end = 0
 
         burst_warning_issued = False
 
+        # The topic is the same for every message so only build it once
+        topic = self.get_topic(self.telemetry_type, self.type_name)
+
         for i in range(1, self.count + 1):
-            payload = json.dumps(
-                {
-                    "msgid": i,
-                    "_generatedAt": datetime.datetime.utcnow().isoformat() + "Z",
-                    **payload_fixed,
-                }
+            generated_at = utcnow().isoformat()
+            payload = (
+                f'{{"msgid": {i}, "_generatedAt": "{generated_at}Z"{payload_suffix}'
             )
 
             payload_bytes += len(payload.encode("utf-8"))
-            topic = self.get_topic(self.telemetry_type, self.type_name)
-            LOG.debug("Publishing message: topic=%s, payload=%s", topic, payload)
-            client.publish(topic, qos=self.qos, payload=payload)
+            if debug_enabled:
+                LOG.debug("Publishing message: topic=%s, payload=%s", topic, payload)
+            publish(topic, qos=qos, payload=payload)
 
             if i % burst_beats == 0:
                 beat_end = time.monotonic()
@@ -488,7 +490,7 @@ def run_benchmark(opts):
     iteration = 1
 
     while iteration <= opts.iterations:
-        LOG.info(f"Running iteration: %d", iteration)
+        LOG.info("Running iteration: %d", iteration)
         for count, beats, beats_delay, period in params:
             setattr(opts, "count", [count])
             setattr(opts, "beats", [beats])
@@ -521,13 +523,31 @@ def run_benchmark(opts):
                             ["sudo", "systemctl", "restart", "tedge-mapper-c8y"]
                         )
 
-                        # Wait for service to come up
-                        time.sleep(5)
+                        # Wait for the new process to report that it is up
+                        mapper_pid = subprocess.check_output(
+                            [
+                                "systemctl",
+                                "show",
+                                "--property=MainPID",
+                                "--value",
+                                "tedge-mapper-c8y",
+                            ],
+                            text=True,
+                        ).strip()
+                        if not wait_for_service_up(
+                            opts.host,
+                            opts.port,
+                            f"{opts.topic_root}/device/main/service/tedge-mapper-c8y/status/health",
+                            int(mapper_pid or 0),
+                        ):
+                            LOG.warning(
+                                "tedge-mapper-c8y did not report being up after the restart"
+                            )
                     else:
                         LOG.warning("Detected dropped messages")
 
-                # Pause before starting next test
-                time.sleep(1)
+            # Let any in-flight cloud messages drain before starting the next test
+            wait_until_idle(opts.host, opts.port, list(CLOUD_TOPICS.values()))
 
         iteration += 1
 
@@ -554,7 +574,104 @@ def run_benchmark(opts):
     return success
 
 
-def configure():
+def wait_for_broker(host: str = "127.0.0.1", port: int = 1883, wait: float = 10.0):
+    """Wait until the MQTT broker is accepting connections
+
+    Args:
+        host (str): MQTT broker host
+        port (int): MQTT broker port
+        wait (float): Time to wait in seconds for the broker to be ready
+    """
+    expire = time.monotonic() + wait
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError as ex:
+            if time.monotonic() > expire:
+                raise RuntimeError(
+                    f"MQTT broker is not ready after {wait} seconds"
+                ) from ex
+            time.sleep(0.1)
+
+
+def wait_for_service_up(
+    host: str, port: int, topic: str, pid: int, wait: float = 30.0
+) -> bool:
+    """Wait until a service publishes an "up" health status from the given process
+
+    Matching on the process id ignores any retained status from a previous instance
+    of the service
+
+    Args:
+        host (str): MQTT broker host
+        port (int): MQTT broker port
+        topic (str): Health status topic of the service
+        pid (int): Process id of the service
+        wait (float): Time to wait in seconds for the service to be up
+
+    Returns:
+        bool: True if the service is up
+    """
+    ready = threading.Event()
+
+    def on_message(_client, _userdata, msg: mqtt.MQTTMessage):
+        try:
+            health = json.loads(msg.payload.decode("utf-8"))
+        except ValueError:
+            return
+        if not isinstance(health, dict):
+            return
+        if health.get("status") == "up" and health.get("pid") == pid:
+            ready.set()
+
+    client = mqtt.Client()
+    client.on_message = on_message
+    client.connect(host, port)
+    client.subscribe(topic)
+    client.loop_start()
+
+    is_up = ready.wait(wait)
+
+    client.disconnect()
+    client.loop_stop()
+    return is_up
+
+
+def wait_until_idle(
+    host: str, port: int, topics: List[str], quiet: float = 0.5, wait: float = 5.0
+):
+    """Wait until no messages have been received on the given topics for a
+    period of time, or until the maximum wait time is reached
+
+    Args:
+        host (str): MQTT broker host
+        port (int): MQTT broker port
+        topics (List[str]): Topics to monitor
+        quiet (float): Time in seconds without any messages before the topics are considered idle
+        wait (float): Maximum time to wait in seconds
+    """
+    last_message = time.monotonic()
+
+    def on_message(_client, _userdata, _msg):
+        nonlocal last_message
+        last_message = time.monotonic()
+
+    client = mqtt.Client()
+    client.on_message = on_message
+    client.connect(host, port)
+    client.subscribe([(topic, 0) for topic in topics])
+
+    expire = time.monotonic() + wait
+    while time.monotonic() < expire:
+        client.loop(timeout=0.1)
+        if time.monotonic() - last_message >= quiet:
+            break
+
+    client.disconnect()
+
+
+def configure(host: str = "127.0.0.1", port: int = 1883):
     """Configure the mosquitto bridge settings to ignore specific messages to
     protect against publishing large volumes of messages to the cloud
     """
@@ -567,14 +684,15 @@ def configure():
 
     text = bridge_config.read_text("utf-8")
 
-    if re.search("^topic measurement/measurements/create", text, re.MULTILINE):
+    # Comment out the topic in a single pass (only matching lines which are not already commented out)
+    measurement_topic = re.compile(
+        r"^topic measurement/measurements/create", re.MULTILINE
+    )
+    text, replacements = measurement_topic.subn(
+        "#topic measurement/measurements/create", text
+    )
+    if replacements:
         restart_required = True
-        text = re.sub(
-            "topic measurement/measurements/create",
-            "#topic measurement/measurements/create",
-            text,
-            re.MULTILINE,
-        )
         LOG.info("Modifying %s file", str(bridge_config))
         bridge_config.write_text(text, encoding="utf-8")
 
@@ -584,7 +702,7 @@ def configure():
             subprocess.check_call(["sudo", "systemctl", "restart", "mosquitto"])
         else:
             subprocess.check_call(["systemctl", "restart", "mosquitto"])
-        time.sleep(1)
+        wait_for_broker(host, port)
 
 
 def register_subcommand(parser: argparse.ArgumentParser):
@@ -658,7 +776,7 @@ Examples:
         if opts.command == "configure":
             configure()
         elif opts.command == "run":
-            configure()
+            configure(opts.host, opts.port)
             LOG.info("Running benchmark")
             success = run_benchmark(opts)
             LOG.info("Finished benchmark")